@@ -12,10 +12,9 @@ names = ["Alice", "Ada", "Grace"]
 print(numbers)
 print(names)
 
-# You can do a traditional counting loop
-n = len(numbers) # length of list
-for i in range(0, n):
-    numbers[i] = numbers[i] + 1
+# You can build a new list from an old one with a list comprehension,
+# which is shorter and faster than a counting loop over the indices
+numbers = [x + 1 for x in numbers]
 print(numbers)
 
 # Or, you can loop over the elements of a list more easily like this
@@ -11,44 +11,48 @@
 # This funs a simple "email" client for the user to look at their messages. 
 # They are give the options to read, delete, or skip the message they are viewing. 
 
-# Imported things from pop-server.py
-from ast import AsyncFunctionDef
-from asyncore import loop, read
-from email import message
-import numbers
-from operator import contains
-import os          # for os.path.isfile()
+import os          # for os.read()
+import selectors   # for waiting on the keyboard with a timeout
 import socket      # for socket stuff
-import sys
-from tabnanny import check         # for sys.argv
-import threading   # for threading.Thread()
-import re          # for regex split()
-import datetime    # for printing timestamps in debug messages
+import sys         # for sys.argv
 import traceback   # for printing exceptions
-import fcntl       # for Posix file locking
 
 
 # Global configuration variables, with default values
 server_host = "enron.kwalsh.org" 
 server_port = 110
+keepalive_interval = 60 # seconds to wait at a prompt before sending a NOOP
 
-# Code taken from pop-client.py 
-def read_one_line(c):
-    data = ""
-    # Keep reading from socket until we get a "\r\n" pair.
-    while not data.endswith("\r\n"):
-        # Read one more byte from socket, append it to our data.
-        try:
-            more_data = c.recv(1)
-            if not more_data:
-                print("Socket connection was lost")
-                return None
-            data += more_data.decode() # decode byte as an ascii character
-        except:
-            print("Error reading from socket: " + traceback.format_exc())
-            return None
-    # Return the accumulate data, without the terminating "\r\n" sequence.
-    return data[:-2]
+# POP3 commands, already encoded as bytes so they can be sent as-is. The ones
+# that take a message number are templates for the % operator.
+USER_T = b"USER %b\r\n"
+PASS = b"PASS hunter2\r\n"  # fixed password command
+STAT = b"STAT\r\n"
+LIST_ALL = b"LIST\r\n"
+RETR_T = b"RETR %u\r\n"
+DELE_T = b"DELE %u\r\n"
+RSET = b"RSET\r\n"
+NOOP = b"NOOP\r\n"
+QUIT = b"QUIT\r\n"
+
+# Code taken from pop-client.py, but reading through a buffered file object
+# wrapped around the socket, so each recv() pulls in up to 4 KiB at a time
+# instead of a single byte.
+def read_one_line():
+    try:
+        line = readline()
+    except:
+        print("Error reading from socket: " + traceback.format_exc())
+        return None
+    # Keep going only if we got a complete line ending with a "\r\n" pair.
+    if not line.endswith(b"\r\n"):
+        print("Socket connection was lost")
+        return None
+    # Return the line, without the terminating "\r\n" sequence. The whole line
+    # is decoded in one go, and any bytes that aren't valid UTF-8 (e.g. from a
+    # message body in some other charset) are shown as replacement characters
+    # rather than crashing the client.
+    return line[:-2].decode(errors="replace")
 
 
 # Get command-line parameters, if present
@@ -68,73 +72,139 @@ print("Connecting to server %s on port %d" % (server_host, server_port))
 server_addr = (server_host, server_port)
 c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 c.connect(server_addr)
+reader = c.makefile('rb', buffering=4096)
+readline = reader.readline  # bound once here, rather than looked up per line
+send = c.sendall            # sends one already-encoded command to the server
+
+keyboard = None # selector watching the keyboard, see watch_keyboard()
+typed = b""     # keyboard input that has been read but not used yet
+
+# Watch the keyboard, so prompt() can tell when the user has typed something.
+# Some kinds of input, like a regular file given with "< answers.txt", can't be
+# watched this way (epoll refuses them). In that case keyboard is left as None,
+# and prompt() just reads without sending any keepalives, since the answers are
+# all already there.
+def watch_keyboard():
+    global keyboard
+    selector = selectors.DefaultSelector()
+    try:
+        selector.register(sys.stdin, selectors.EVENT_READ)
+    except (OSError, ValueError):
+        selector.close()
+        return
+    keyboard = selector
+
+# Ask the user a question and return the line they type, like input(). While
+# waiting, send a NOOP every keepalive_interval seconds so the server doesn't
+# drop the connection for being idle while the user is thinking.
+def prompt(question):
+    global typed
+    print(question, end="", flush=True)
+    while b"\n" not in typed:
+        if keyboard is None or keyboard.select(timeout=keepalive_interval):
+            more_typed = os.read(sys.stdin.fileno(), 4096)
+            if not more_typed:
+                raise EOFError
+            typed += more_typed
+        else:
+            send(NOOP)
+            read_one_line() # skip the +OK
+    line, _, typed = typed.partition(b"\n")
+    return line.decode(errors="replace")
 
 # Log in the user given the user input 
 
 def logging_in(user):
-    cmd = "USER %s"%user    # assign user input to USER command
-    cmd2 = "PASS hunter2"   # fixed password command
-    cmd3 = "LIST"           # list command for later 
-
-    err = "ERR"
-    #print(cmd)
-    c.sendall((cmd + "\r\n").encode()) # first 
+    send(USER_T % user.encode()) # first 
     
-    resp1 = read_one_line(c)           # get response from server
-    resp1 = read_one_line(c)           # and skip one of the lines
+    resp1 = read_one_line()           # get response from server
     
-    if err in resp1:                                    # check if -ERR is in the message
+    if resp1 is None or resp1.startswith("-ERR"):       # check if the response starts with -ERR
         print("Failed. Server error was: %s"%resp1)     # if so, EXIT 
         sys.exit(1)
 
     # print it
-    elif resp1 is not None:                             
+    else:
     #print("Response: " + resp)
-        c.sendall((cmd2 + "\r\n" ).encode())           # Enter PASS hunter2 to log in  
-        resp2 = read_one_line(c)
-        if err in resp2:                               # Check if -ERR is in the message
-            print("Failed. Server error was: %s"%resp1)
+        send(PASS)                                     # Enter PASS hunter2 to log in  
+        resp2 = read_one_line()
+        if resp2 is None or resp2.startswith("-ERR"):  # Check if the response starts with -ERR
+            print("Failed. Server error was: %s"%resp2)
             sys.exit(1)
 
 # Print the Messages
 def printMessage():
-    #message = read_one_line(c)
+    read = read_one_line # local names are faster to look up inside the loop
+    write = print
     while True:
-        message = read_one_line(c)
-        print(message)
-        if message is ".":
+        message = read()
+        if message is None:
+            break
+        write(message)
+        if message == ".":
             break
 
-# Delete via POP3 and ask the user to confirm
+# Ask the user to confirm, then queue the message to be deleted via POP3
 def confirm_delete(n):
-    confirmation = input("Are you sure you want to delete this message?(y/n)")
-    if confirmation is 'y':
-        c.sendall(("DELE %u"%n+ "\r\n" ).encode())  
+    confirmation = prompt("Are you sure you want to delete this message?(y/n)")
+    if confirmation == 'y':
+        pending_deletes.append(n)
         print("Message %u marked for deletion in mailbox!"%(n))
-        delete_message = read_one_line(c) # skip the delete message
+
+# Send all the queued DELE commands in one go, then read back all of their
+# responses, so a page of deletions costs one round trip instead of several
+def flush_deletes():
+    if len(pending_deletes) == 0:
+        return
+    send(b"".join(DELE_T % n for n in pending_deletes))
+    read = read_one_line
+    for n in pending_deletes:
+        delete_message = read() # skip the delete message
+    del pending_deletes[:]
 
 # Get the mailbox stats regarding the amount of messages 
 def mailbox_info(): 
-    c.sendall(("STAT"+ "\r\n" ).encode()) 
-    mailbox = read_one_line(c)
+    send(STAT)
+    mailbox = read_one_line()
     #print(mailbox)
-    stats = mailbox.split(" ")[1]
+    stats = mailbox.split(" ", 2)[1]
     #print("meowww",stats)
-    if stats is "'STAT'":
+    if stats == "'STAT'":
         sys.exit(1)
-    elif stats is '0':
+    elif stats == '0':
         print("You have %s messages!"%stats)
         sys.exit(1) 
     else:
         print("You have %s messages!"%stats)
         return int(stats)
 
-# Lists the message of a giving message number and returns the message
-def get_message(box_number):
-    c.sendall(("LIST %u"%box_number + "\r\n").encode())
-    #print("MEOW!")
-    mail = read_one_line(c)
-    return mail 
+# Yields each line of a multiline response, stopping at the "." line that
+# ends it (or if the connection is lost)
+def read_lines_until_dot():
+    read = read_one_line # local names are faster to look up inside the loop
+    while True:
+        line = read()
+        if line is None or line == ".":
+            return
+        yield line
+
+# Lists all the messages with a single LIST command and returns a list of
+# (size, info) pairs, indexed by message number, so printing a page of
+# messages is just a lookup with no more traffic to the server
+def list_messages():
+    send(LIST_ALL)
+    read_one_line() # skip the +OK line
+    listing = [None] # there is no message 0
+    for mail in read_lines_until_dot():
+        # each line is "n size", which this server follows with some info
+        # about the message, but other servers might not
+        parts = mail.split(" ", 2)
+        if len(parts) > 2:
+            info = parts[2]
+        else:
+            info = ""
+        listing.append((int(parts[1]), info))
+    return listing
 
 # Check if the messages have all been read 
 def check_if_done(p): 
@@ -144,7 +214,13 @@ def check_if_done(p):
         return False
 # Finally, the main user-interaction loop.
 try:
+    watch_keyboard()
+
     # Server sends a greeting first thing, so receive that and print it
+    greeting = read_one_line()
+    if greeting is None or not greeting.startswith("+OK"):
+        print("Failed. Server greeting was: %s"%greeting)
+        sys.exit(1)
     print("Connected!  Welcome to POP3 demo for csci356")
     print("Logging in to server as user %s with default password." %user_name)
 
@@ -152,32 +228,33 @@ try:
     done = False                        # boolean to keep track if the user is done
     loop_check = 0                      # counter for amount of loops to increment loop values
     delete_counter = 0                  # track how many messages are to be deleted
+    pending_deletes = []                # messages waiting for their DELE command to be sent
     mail_amount = int(mailbox_info())   # store the number of messages into an integer
+    listing = list_messages()           # fetch the listing for every message at once
     
 
     # Next, repeatedly get user input and send it to the server,
     # then print whatever response the server sends back.
     while True:
-        inp = input("Type 'q' at any time to quit, or hit enter to see the list of messages.\r\n")
-        if inp is 'q': # quit 
+        inp = prompt("Type 'q' at any time to quit, or hit enter to see the list of messages.\r\n")
+        if inp == 'q': # quit 
             break
         else:
             i = (5 * loop_check) # view the messages 5 at a time
             j = (5 * loop_check) # asking the user about messages 5 at a time
             #print(i, loop_check)
-            for i in range(i, i+5): # print the emails in this first loop, but ONLY 5 at a time
-                emails = get_message(i+1)
-                emails = emails[5:]
-                print("[%u] %s"%(i+1,emails))
+            for i in range(i, min(i+5, mail_amount)): # print the emails in this first loop, but ONLY 5 at a time
+                size, info = listing[i+1]
+                print("[%u] %u %s"%(i+1,size,info))
 
             for j in range(j, j+5): # Now, cycle through those messages one at a time, asking the user whether or not to read, delete, or skip
-                readSkipDelete = input("Do you want to (r)ead, (d)elete, or (s)kip message %u\r\n"%(j+1))
-                if readSkipDelete is 'r': # if user wants to read message
-                    c.sendall(("RETR %u"%(j+1) + "\r\n" ).encode())
+                readSkipDelete = prompt("Do you want to (r)ead, (d)elete, or (s)kip message %u\r\n"%(j+1))
+                if readSkipDelete == 'r': # if user wants to read message
+                    send(RETR_T % (j+1))
                     print("[start of message] %u"%(j+1))
                     printMessage()
-                    deleteOrSkip = input("Do you want to (d)elete, or (s)kip message %u\r\n"%(j+1))
-                    if  deleteOrSkip is 'd': # if user is sure that they want to delete message
+                    deleteOrSkip = prompt("Do you want to (d)elete, or (s)kip message %u\r\n"%(j+1))
+                    if  deleteOrSkip == 'd': # if user is sure that they want to delete message
                         confirm_delete(j+1)
                         delete_counter = delete_counter + 1
                         if check_if_done(j):
@@ -188,25 +265,26 @@ try:
                             done = True
                             break
                         continue
-                elif readSkipDelete is 'd': # if the user wants to delete 
+                elif readSkipDelete == 'd': # if the user wants to delete 
                     confirm_delete(j+1)
                     delete_counter = delete_counter + 1
                     if check_if_done(j):
                         done = True
                         break
-                elif readSkipDelete is 's': # if the user wants to skip 
+                elif readSkipDelete == 's': # if the user wants to skip 
                     if check_if_done(j):
                         done = True
                         #print(done)
                         break
                     else: # continue reading the messages
                         continue 
-                elif readSkipDelete is 'q': # if the user wants to quit at any time
+                elif readSkipDelete == 'q': # if the user wants to quit at any time
                     done = True
                     break 
                 else: 
                     print("Try again clicking the correct keys: r, d, s, or q :)") # exit if they do not put a readable key
                     sys.exit(1)   
+            flush_deletes() # tell the server about this page's deletions
             if done: # if done = TRUE, then break out of loop and give last messages
                 break 
             loop_check = loop_check + 1
@@ -216,22 +294,25 @@ try:
     ## not delete them. Then, quit. 
     if delete_counter > 0: # Only ask if the user has messages to delete
         print("You have %u messages marked for deletion!"%delete_counter) 
-        yes_or_no = input("Do you want to delete the messages you marked for deletion?(y/n)") # confirm with user to delete messages
-        if yes_or_no is 'y': 
+        yes_or_no = prompt("Do you want to delete the messages you marked for deletion?(y/n)") # confirm with user to delete messages
+        if yes_or_no == 'y': 
             print("You deleted %u messages!"%delete_counter)
-            c.sendall(("QUIT" + "\r\n").encode())           # actually delete the messages
-            quit = read_one_line(c)
+            send(QUIT)                                      # actually delete the messages
+            quit = read_one_line()
             print(quit)
         else: 
             print("[%u messages unmarked for deletion]"%delete_counter) 
-            c.sendall(("RSET" + "\r\n").encode())           # unmark the messages that are supposed to be deleted 
-            ending = read_one_line(c)
+            send(RSET)                                      # unmark the messages that are supposed to be deleted 
+            ending = read_one_line()
     
     print("You have gone through all of your messages! Goodbye :)") # Goodbye statement. 
                           
 finally:   
     
     print("Closing socket connection to server")
+    if keyboard is not None:
+        keyboard.close()
+    reader.close()
     c.close()
 
 print("Done") #End
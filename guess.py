@@ -21,7 +21,4 @@ while True:
         wrong_guesses.append(x)
 
 print("You made %d incorrect guesses!" % (len(wrong_guesses)))
-sum = 0
-for x in wrong_guesses:
-    sum = sum + x
-print("The sum of all your wrong guesses is", sum)
+print("The sum of all your wrong guesses is", sum(wrong_guesses))
@@ -8,27 +8,24 @@ import sys # need this for exit()
 
 def newton_approx_sqrt(n):
     # This function takes a number n and returns an approximation
-    # for sqrt(n). It does this using newton's method.
-    guess = 1.0
-    print("Starting with ", guess)
-    while distance(guess*guess, n) > 0.001:
-        guess = better_approx(n, guess)
-        print("Next guess is ", guess)
+    # for sqrt(n). It does this using newton's method: given a guess g,
+    # n/g is on the other side of sqrt(n), so their average is a better
+    # guess. The loop is kept tight, with no function calls or printing.
+    if n == 0:
+        return 0.0
+    # Start from a power of two within a factor of 2 of the answer, so even
+    # huge or tiny numbers converge in a handful of steps.
+    guess = 2.0 ** (math.frexp(n)[1] // 2)
+    # Stop once a step no longer changes the guess relative to its size,
+    # i.e. we are at the limit of float precision. An absolute tolerance on
+    # guess*guess can't be met for large n, so it might never stop.
+    for _ in range(64):
+        old = guess
+        guess = 0.5 * (n/guess + guess)
+        if abs(guess - old) <= 1e-15 * guess:
+            break
     return guess
 
-def distance(a, b):
-    # Returns the distance between a and b
-    return abs(b - a)
-
-def better_approx(n, s):
-    # This function takes a number n and returns an approximation
-    # for sqrt(n), where the argument s is a starting guess.
-    # The result will be no worse an approximation than s was.
-    p = float(n) / float(s)
-    # Now, n equals p times s, so sqrt(n) is somewhere between p and s
-    avg = (p + s) / 2.0
-    return avg
-
 
 # The main program...
 x = float(input("Please enter a number: "))
@@ -20,23 +20,32 @@
 #
 # Any user with a mailbox file can log in with the password "hunter2".
 #
-# This code is multi-threaded: for each incoming connection from a client, we
-# start a separate thread to handle interaction with that client. This means
-# there can be multiple concurrent connections being processed at the same time.
-# This program has no global variables, though, so this doesn't cause problems.
+# This code uses asyncio: each incoming connection from a client is handled by
+# its own coroutine, and all of them take turns running on a single thread.
+# Whenever one connection is waiting for the network, the others get to run.
+# This means there can be multiple concurrent connections being processed at
+# the same time, without the memory and scheduling cost of one thread each.
 #
 # Note: This code is not "pythonic" at all; there are more concise ways to write
 # this code by using python features like dicts and string interpolation. We
 # also avoid use of any outside modules except for a few basic ones.
 
-import os          # for os.path.isfile()
+import asyncio     # for asyncio.start_server() and friends
+import concurrent.futures # for concurrent.futures.ThreadPoolExecutor()
+import os          # for os.path.isfile() and os.scandir()
 import socket      # for socket stuff
 import sys         # for sys.argv
-import threading   # for threading.Thread()
+import threading   # for threading.current_thread() and threading.Thread()
+import queue       # for queue.SimpleQueue()
+import atexit      # for atexit.register()
+import time        # for time.time()
 import re          # for regex split()
+import tempfile    # for tempfile.TemporaryFile()
 import datetime    # for printing timestamps in debug messages
 import traceback   # for printing exceptions
 import fcntl       # for Posix file locking
+import array       # for array.array()
+import mmap        # for mmap.mmap()
 
 
 # Global constants, with default values.
@@ -44,52 +53,141 @@ import fcntl       # for Posix file locking
 server_host = ""        # empty string means "use any available network interface"
 server_port = 110       # 110 is the standard POP3 TCP port
 mail_dir = "./var_mail" # normally /var/mail/, but this is better for testing
+mbox_threads = 4        # worker threads for opening, parsing and saving mailboxes
+send_buffer = 1 << 20   # socket send buffer size, in bytes, for each connection
+
+# Mailbox files are opened, parsed and saved on a small, fixed pool of worker
+# threads, so that a big mailbox doesn't hold up every other connection. With
+# the usual GIL only one of them can run python code at a time anyway, but a
+# free-threaded python can run one per CPU in parallel.
+if hasattr(sys, "_is_gil_enabled") and not sys._is_gil_enabled():
+    mbox_threads = os.cpu_count() or mbox_threads
+
+# Responses that never change, encoded once at startup rather than every time
+# they are sent. Responses with numbers in them are bytes templates for the %
+# operator, which skips the separate encoding step.
+GREETING = b"+OK Welcome to POP3 demo for csci356\r\n"
+WRONG_PASSWORD = b"-ERR Sorry, wrong password, be sure to use the fake one\r\n"
+STAT_OK = b"+OK %d %d\r\n"
+LIST_HEADER = b"+OK listing for %d messages (%d bytes total) follows\r\n"
+RETR_HEADER = b"+OK message %d (%d bytes total) follows\r\n"
+END_OF_MSG = b".\r\n"
+NOOP_OK = b"+OK\r\n"
+DELE_OK = b"+OK message %d marked for deletion\r\n"
+RSET_OK = b"+OK unmarked %d messages previosly marked for deletion\r\n"
+GOODBYE_SAVED = b"+OK goodbye, deleted %d messages, your mailbox is saved\r\n"
+GOODBYE_NO_CHANGE = b"+OK goodbye, no mailboxes were changed\r\n"
+CONFUSED = b"-ERR Sorry, I'm confused\r\n"
+
+# Regular expressions, compiled once at startup rather than on every use.
+# _USER_NAME matches the user names we are willing to look up. _FROM_SPLIT
+# finds the "From " that starts each message in an mbox file, either at the
+# very start of the file or just after a blank line, and its first group is
+# the line ending just before the blank line. _FROM_QUOTE finds any other line
+# within a message that starts with "From " (or ">From ", ">>From ", etc.), and
+# _FROM_UNQUOTE finds those lines again when saving the mailbox. _DOT_STUFF
+# finds every line of a message that starts with ".". _LINE_END finds the end
+# of a line. Like bytes.splitlines(), _FROM_SPLIT and _LINE_END accept "\n",
+# "\r\n" or a lone "\r" as a line ending.
+_USER_NAME = re.compile(rb'^[a-zA-Z]+[0-9]*\Z')
+_FROM_SPLIT = re.compile(rb'(?:\A(?:\r\n?|\n)?|(\r\n|\r(?!\n)|\n)(?:\r\n|\r(?!\n)|\n))From ')
+_FROM_QUOTE = re.compile(rb'(?m)^(>*From )')
+_FROM_UNQUOTE = re.compile(rb'(?m)^>(>*From )')
+_DOT_STUFF = re.compile(rb'(?m)^\.')
+_LINE_END = re.compile(rb'\r\n?|\n')
 
 
 # log() prints a message to the console, for debugging.
-# Since multi-threading can jumble up the order of output on the screen, we
-# print out the current thread's name on each line of output. We also include a
-# timestamp with each message.
-def log(debugmsg):
-    prefix = str(datetime.datetime.now()) + " " + threading.current_thread().name
-    # When printing multiple lines, indent each line a bit
-    indent = (" " * len(prefix))
-    linebreak = "\n" + indent + ": "
-    lines = debugmsg.splitlines()
-    debugmsg = linebreak.join(lines)
-    # Print it all out.
-    print(prefix + ": " + debugmsg)
-
+# Since concurrent connections can jumble up the order of output on the screen,
+# we print out the current task's name (or thread's name, outside of any task)
+# on each line of output. We also include a timestamp with each message.
+#
+# log() itself only notes the time and puts the message on a queue. A separate
+# logging thread, running print_log_messages(), does the formatting and the
+# actual printing, so connections and worker threads never have to wait for
+# the console. The message may also be given as bytes, e.g. a line received
+# from a client, in which case the logging thread decodes it too.
+log_queue = queue.SimpleQueue()
 
-# recv_one_line() reads data from socket c until a "\r\n" prair is detected.
+def log(debugmsg):
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None # no event loop is running
+    if task is not None:
+        name = task.get_name()
+    else:
+        name = threading.current_thread().name
+    log_queue.put((time.time(), name, debugmsg))
+
+# print_log_messages() prints everything put on the log queue, in order, until
+# it finds None on the queue.
+def print_log_messages():
+    while True:
+        item = log_queue.get()
+        if item is None:
+            break
+        (when, name, debugmsg) = item
+        if isinstance(debugmsg, bytes):
+            debugmsg = debugmsg.decode(errors="replace")
+        prefix = str(datetime.datetime.fromtimestamp(when)) + " " + name
+        # When printing multiple lines, indent each line a bit
+        indent = (" " * len(prefix))
+        linebreak = "\n" + indent + ": "
+        lines = debugmsg.splitlines()
+        debugmsg = linebreak.join(lines)
+        # Print it all out.
+        print(prefix + ": " + debugmsg)
+
+# stop_logging() waits for the logging thread to print whatever is left on the
+# log queue, then stops it. It runs automatically when the program exits.
+def stop_logging():
+    log_queue.put(None)
+    log_thread.join()
+
+
+# recv_one_line() reads data from reader until a "\r\n" prair is detected.
 # It returns all the data received as a python string, not including the
 # terminating "\r\n" pair. As an extra server-only debugging feature, this
 # function also looks for any stray newline "\n" in the incoming data, and
 # immediately stops if one is found. This is because no proper POP3 client
 # should ever send a single newline, and should always end a line with a "\r\n"
 # pair. This function returns a pair containing the data and an error message.
-def read_one_line(c):
-    data = ""
-    # Keep reading from socket, one byte at a time, until we get a "\r\n" pair.
-    while not data.endswith("\r\n"):
-        # Check for stray newlines.
-        if "\n" in data:
-            log("Client sent plain newline, dropping data");
-            return (None, "You sent a plain '\\n'. Did you mean to send a '\\r\\n' pair?")
-        # Read one more byte from socket, append it to our data.
-        try:
-            more_data = c.recv(1)
-            if not more_data:
-                log("Socket connection was lost")
-                return (None, None)
-            data += more_data.decode() # decode byte as an ascii character
-        except:
-            log("Error reading from socket: " + traceback.format_exc())
-            return (None, None)
-    # Return the accumulate data, without the terminating "\r\n" sequence.
+#
+# The reader is an asyncio.StreamReader, which reads from the socket in large
+# chunks and buffers whatever is left over for the next call.
+async def read_one_line(reader):
+    # Keep reading until we get a "\n", which should be part of a "\r\n" pair.
+    try:
+        data = await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError:
+        log("Socket connection was lost")
+        return (None, None)
+    except Exception:
+        log("Error reading from socket: " + traceback.format_exc())
+        return (None, None)
+    # Check for stray newlines.
+    if not data.endswith(b"\r\n"):
+        log("Client sent plain newline, dropping data");
+        return (None, "You sent a plain '\\n'. Did you mean to send a '\\r\\n' pair?")
+    # Return the data as bytes, without the terminating "\r\n" sequence.
+    # Commands are parsed as bytes too, and log() leaves decoding to the logging
+    # thread, so a command never needs decoding on the connection's path.
+    # Anything that isn't plain ascii gets an error response rather than
+    # dropping the connection.
+    if not data.isascii():
+        log("Client sent non-ascii data, dropping data")
+        return (None, "You sent some non-ASCII characters, but POP3 commands must be plain ASCII")
     return (data[:-2], None)
 
 
+# send() sends data to the client, then waits until it has been written out to
+# the socket (or at least handed off to the operating system).
+async def send(writer, data):
+    writer.write(data)
+    await writer.drain()
+
+
 # Each POP3 client connection can be in any one these states:
 states = [
         "INITIALIZATION", # client has just connected, we will send welcome
@@ -102,20 +200,21 @@ states = [
 
 
 # List of valid POP3 commands. For each, list how many arguments it expects, and
-# which states it is allowed in.
+# which states it is allowed in. Keywords are bytes, since that is how they
+# arrive from read_one_line().
 valid = {
-        "QUIT": (None,                   "any"),
-        "USER": ("one string",           "AUTHORIZATION"),
-        "PASS": ("one string",           "AUTHORIZATION (just after USER command)"),
-        "STAT": (None,                   "TRANSACTION"),
-        "LIST": ("one optional integer", "TRANSACTION"),
-        "RETR": ("one integer",          "TRANSACTION"),
-        "DELE": ("one integer",          "TRANSACTION"),
-        "NOOP": (None,                   "TRANSACTION"),
-        "RSET": (None,                   "TRANSACTION")
+        b"QUIT": (None,                   "any"),
+        b"USER": ("one string",           "AUTHORIZATION"),
+        b"PASS": ("one string",           "AUTHORIZATION (just after USER command)"),
+        b"STAT": (None,                   "TRANSACTION"),
+        b"LIST": ("one optional integer", "TRANSACTION"),
+        b"RETR": ("one integer",          "TRANSACTION"),
+        b"DELE": ("one integer",          "TRANSACTION"),
+        b"NOOP": (None,                   "TRANSACTION"),
+        b"RSET": (None,                   "TRANSACTION")
         }
 
-# parse_message_number() converts string s into an integer, but also
+# parse_message_number() converts bytes s into an integer, but also
 # performs some sanity checks to ensure it is a valid message number. It
 # returns a pair of the integer and an error message (or None if no error).
 def parse_message_number(s, msgcount, deletions):
@@ -124,8 +223,8 @@ def parse_message_number(s, msgcount, deletions):
     try:
         msgno = int(s)
     except:
-        log("Rejecting because '%s' is not an integer" % (s))
-        err = "You sent '%s', but that is not an integer" % (s)
+        log("Rejecting because '%s' is not an integer" % (s.decode()))
+        err = "You sent '%s', but that is not an integer" % (s.decode())
     if err is None and (msgno <= 0 or msgno > msgcount):
         log("Message number %d is not valid" % (msgno))
         err = "Sorry, message number %d does not exist" % (msgno)
@@ -135,12 +234,12 @@ def parse_message_number(s, msgcount, deletions):
     return (msgno, err)
 
 
-# parse_pop3_command() splits a line into keyword and argument parts. It also
-# does lots of sanity checking. It returns a 3-tuple containning the keyword, a
-# list of arguments (or an emptylist if there were no arguments), and an error
-# message (or None if there were no errors).
+# parse_pop3_command() splits a line into keyword and argument parts, all
+# kept as bytes. It also does lots of sanity checking. It returns a 3-tuple
+# containning the keyword, a list of arguments (or an emptylist if there were
+# no arguments), and an error message (or None if there were no errors).
 def parse_pop3_command(line, curstate, msgcount, deletions):
-    words = line.split(' ')
+    words = line.split(b' ')
     if len(words) == 0:
         return (None, [], "You sent an empty string")
     keyword = words[0].upper()
@@ -148,29 +247,29 @@ def parse_pop3_command(line, curstate, msgcount, deletions):
     n = len(args)
     # Sanity check: make sure keyword is in our list of valid commands
     if keyword not in valid:
-        err = "You sent '%s', but that is not a recognized command" % (keyword)
+        err = "You sent '%s', but that is not a recognized command" % (keyword.decode())
         return (None, [], err)
     (validarg, validstate) = valid[keyword]
     # Sanity check: make sure we are in an appropriate state for that command
     if (curstate != validstate) and (validstate != "any"):
-        err = "'%s' only works in %s state, but server is in %s state" % (keyword, validstate, curstate)
+        err = "'%s' only works in %s state, but server is in %s state" % (keyword.decode(), validstate, curstate)
         return (None, [], err)
     # Sanity check: make sure none of the arguments are empty strings
-    if "" in args:
+    if b"" in args:
         err = "You sent an empty argument, e.g. trailing spaces, or adjacent spaces"
         return (None, [], err)
     # Sanity check: make sure we have appropriate number of arguments
     if validarg == None and n != 0:
-        err = "%s takes no arguments, but you sent %s of them" % (keyword, n)
+        err = "%s takes no arguments, but you sent %s of them" % (keyword.decode(), n)
         return (None, [], err)
     if validarg == "one string" and n != 1:
-        err = "%s takes one string argument, but you sent %s of them" % (keyword, n)
+        err = "%s takes one string argument, but you sent %s of them" % (keyword.decode(), n)
         return (None, [], err)
     if validarg == "one integer" and n != 1:
-        err = "%s takes one integer argument, but you sent %s of them" % (keyword, n)
+        err = "%s takes one integer argument, but you sent %s of them" % (keyword.decode(), n)
         return (None, [], err)
     if validarg == "one optional integer" and n > 1:
-        err = "%s takes one optional integer argument, but you sent %s of them" % (keyword, n)
+        err = "%s takes one optional integer argument, but you sent %s of them" % (keyword.decode(), n)
         return (None, [], err)
     # Sanity check: make integer arguments are valid message numbers
     if n == 1 and (validarg == "one integer" or validarg == "one optional integer"):
@@ -184,10 +283,21 @@ def parse_pop3_command(line, curstate, msgcount, deletions):
 
 # handle_pop3_connection() runs the entire POP3 protocol for a single client
 # connection. It sends a greeting, then waits for client messages and responds
-# appropriately to those messages.
-def handle_pop3_connection(c, client_addr):
+# appropriately to those messages. The error handling here (and in
+# read_one_line) only catches Exception, so that when the server shuts down and
+# cancels a connection, the cancellation isn't mistaken for an error.
+async def handle_pop3_connection(reader, writer):
+    client_addr = writer.get_extra_info("peername")
     log("Welcoming connection from " + str(client_addr))
 
+    # Send small responses right away, rather than waiting (Nagle's algorithm)
+    # to see if more data comes along to fill up a packet. Since each response
+    # is sent all at once, this doesn't cause lots of tiny packets. Also give
+    # the kernel a big enough send buffer to take a large message in one go.
+    sock = writer.get_extra_info("socket")
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+
     # POP3 is a "stateful" protocol, meaning there are long-lived variables on
     # the server associated with each client connection. When a connection dies,
     # this function returns, and the variables here are discarded. Here are the
@@ -195,179 +305,206 @@ def handle_pop3_connection(c, client_addr):
     state = "INITIALIZATION" # the state of this connection, i.e. what it is doing
     user = None              # user that has (or started to) login on this connection
     mbox = None              # mailbox of that user, after the password is given
-    msgs = []                # list of messages parsed from mbox file  
-    deletions = []           # list of message numbers to be deleted
+    senders = []             # source of each message parsed from mbox file
+    subjects = []            # subject of each message
+    sizes = array.array('q') # size of each message, in bytes
+    bodies = []              # contents of each message
+    list_lines = []          # LIST response line for each message, as bytes
+    offsets = array.array('q') # where each message starts in the mbox file
+    deletions = set()        # set of message numbers to be deleted
+    spool = None             # temporary file with messages ready to send, see spool_messages()
+    extents = []             # (offset, length) of each message within spool
+    live_count = 0           # number of messages not marked for deletion
+    live_bytes = 0           # total size of messages not marked for deletion
 
     # POP3 protocol is a greeting, followed by request, response pairs
     try:
         # send the greeting
-        c.sendall(b"+OK Welcome to POP3 demo for csci356\r\n")
+        await send(writer, GREETING)
         state = "AUTHORIZATION"
 
         while True:
             # wait for one request from the client
-            (line, err) = read_one_line(c)
+            (line, err) = await read_one_line(reader)
             if err is not None:
                 log("Sending error response: " + err)
-                c.sendall(("-ERR " + err + "\r\n").encode())
+                await send(writer, ("-ERR " + err + "\r\n").encode())
                 continue
             if line is None:
                 break
-            log("Received from client: " + line)
+            log(b"Received from client: " + line)
             
             # easter egg: if we get polite request to exit, then do so
-            if line == "would you please exit":
+            if line == b"would you please exit":
                 log("Exiting soon.")
-                global done
-                done = True
+                shutdown_requested.set()
                 break
 
             # examine that request, and do something based on it
-            (keyword, args, err) = parse_pop3_command(line, state, len(msgs), deletions)
+            (keyword, args, err) = parse_pop3_command(line, state, len(sizes), deletions)
 
             # if command wasn't recognized at all, just send an error response
             if err is not None:
                 log("Sending error response: " + err)
-                c.sendall(("-ERR " + err + "\r\n").encode())
+                await send(writer, ("-ERR " + err + "\r\n").encode())
 
             # USER command in AUTHORIZATION state does sanity checks on
             # username, then switches to AUTHORIZATION (just after USER command) state
-            elif keyword == "USER":
-                user = args[0]
+            elif keyword == b"USER":
+                # the user name is only decoded here, since it is needed as a
+                # string for the mbox file name and the messages below
+                user = args[0].decode()
                 log("Checking username: " + user)
                 # a few sanity checks on username
-                if not re.match('^[a-zA-Z]+[0-9]*$', user):
+                if not _USER_NAME.match(args[0]):
                     log("Rejecting due to suspicious characters")
-                    c.sendall(("-ERR Sorry, user name " + user + " looks too suspicious\r\n").encode())
+                    await send(writer, ("-ERR Sorry, user name " + user + " looks too suspicious\r\n").encode())
                     user = None
                 elif os.path.isfile(mail_dir + "/" + user):
                     log("Username seems legit, now waiting for PASS command")
-                    c.sendall(("+OK Hi "+user+", ready for your super secret password\r\n").encode())
+                    await send(writer, ("+OK Hi "+user+", ready for your super secret password\r\n").encode())
                     state = "AUTHORIZATION (just after USER command)"
                 else:
                     log("Rejecting because mbox file %s/%s is missing" % (mail_dir, user))
-                    c.sendall(("-ERR Sorry, user name " + user + " doesn't seem to have a mailbox\r\n").encode())
+                    await send(writer, ("-ERR Sorry, user name " + user + " doesn't seem to have a mailbox\r\n").encode())
                     user = None
 
             # PASS command in AUTHORIZATION (just after USER command) state checks
             # the password, then switches to TRANSACTION state
-            elif keyword == "PASS":
+            elif keyword == b"PASS":
                 passwd = args[0]
-                log("Checking password: " + passwd)
-                if passwd == "hunter2":
-                    mbox, err = open_and_lock_mbox(user)
+                log(b"Checking password: " + passwd)
+                if passwd == b"hunter2":
+                    mbox, err = await asyncio.to_thread(open_and_lock_mbox, user)
                     if err is None:
-                        msgs = parse_mbox(mbox)
-                        if msgs is None:
+                        parsed = await asyncio.to_thread(parse_mbox, mbox)
+                        if parsed is None:
                             err = "Something went wrong when parsing the mbox file"
-                            unlock_and_close_mbox(mbox, user, None, None)
+                            await asyncio.to_thread(unlock_and_close_mbox, mbox, user, None, None, None, None)
                             mbox = None
-                            msgs = []
+                        else:
+                            (senders, subjects, sizes, bodies, list_lines, offsets) = parsed
                     if err is None:
+                        spool, extents = await asyncio.to_thread(spool_messages, bodies)
+                        if spool is None:
+                            err = "Something went wrong when preparing the messages"
+                            await asyncio.to_thread(unlock_and_close_mbox, mbox, user, None, None, None, None)
+                            mbox = None
+                            senders, subjects, sizes, bodies, list_lines, offsets = [], [], array.array('q'), [], [], array.array('q')
+                            extents = []
+                    if err is None:
+                        live_count = len(sizes)
+                        live_bytes = sum(sizes)
                         log("Password accepted, mailbox opened")
-                        c.sendall(("+OK nice guess, you are now logged in as "+user+"\r\n").encode())
+                        await send(writer, ("+OK nice guess, you are now logged in as "+user+"\r\n").encode())
                         state = "TRANSACTION"
                     else:
                         log("Password accepted, but mailbox could not be opened")
-                        c.sendall(("-ERR " + err + "\r\n").encode())
+                        await send(writer, ("-ERR " + err + "\r\n").encode())
                 else:
                     log("Rejecting due to wrong password")
-                    c.sendall(("-ERR Sorry, wrong password, be sure to use the fake one\r\n").encode())
+                    await send(writer, WRONG_PASSWORD)
 
             # STAT command in TRANSACTION state returns some statistics to client
-            elif keyword == "STAT":
-                nn = len(msgs) - len(deletions)
-                mm = sum([len(msg[2]) for (i, msg) in enumerate(msgs) if (i+1) not in deletions])
+            elif keyword == b"STAT":
+                nn = live_count
+                mm = live_bytes
                 log("Sending status message for %d messages" % (nn))
-                c.sendall(("+OK %d %d\r\n" % (nn, mm)).encode())
+                await send(writer, STAT_OK % (nn, mm))
 
             # LIST command in TRANSACTION state lists info about all messages,
             # or if an argument was given, just the one specified message
-            elif keyword == "LIST":
+            elif keyword == b"LIST":
                 if len(args) == 0:
-                    nn = len(msgs) - len(deletions)
-                    mm = sum([len(msg[2]) for (i, msg) in enumerate(msgs) if (i+1) not in deletions])
+                    nn = live_count
+                    mm = live_bytes
                     log("Sending listing for all %d un-marked messages" % (nn))
-                    c.sendall(("+OK listing for %d messages (%d bytes total) follows\r\n" % (nn, mm)).encode())
-                    for (i, msg) in enumerate(msgs):
-                        if (i+1) not in deletions:
-                            c.sendall(("%d %d %s %s\r\n" % (i+1, len(msg[2]), msg[0], msg[1])).encode())
-                    c.sendall(b".\r\n")
+                    # build the whole response first, from the lines prepared
+                    # by parse_mbox(), then send it all at once
+                    out = [LIST_HEADER % (nn, mm)]
+                    out.extend(list_lines[i] for i in range(len(list_lines)) if (i+1) not in deletions)
+                    out.append(END_OF_MSG)
+                    await send(writer, b"".join(out))
                 else:
                     msgno = args[0]
                     log("Sending info about message %d" % (msgno))
-                    msg = msgs[msgno-1]
-                    c.sendall(("+OK %d %d %s %s\r\n" % (msgno, len(msg[2]), msg[0], msg[1])).encode())
+                    i = msgno-1
+                    await send(writer, b"+OK " + list_lines[i])
 
             # RETR command in TRANSACTION state retrieves one message
-            elif keyword == "RETR":
+            elif keyword == b"RETR":
                 msgno = args[0]
-                msg = msgs[msgno-1]
                 log("Sending contents of message %d" % (msgno))
-                c.sendall(("+OK message %d (%d bytes total) follows\r\n" % (msgno, len(msg[2]))).encode())
-                for line in msg[2].splitlines(False):
-                    # if a line starts with "." we must "byte-stuff" an extra
-                    # "." at the start, because a lone "." is used to mark the
-                    # end of the message
-                    if line.startswith("."):
-                        line = "." + line
-                    c.sendall((line + "\r\n").encode())
-                c.sendall(b".\r\n")
+                await send(writer, RETR_HEADER % (msgno, sizes[msgno-1]))
+                # the message itself goes straight from the spool file to the
+                # socket, using sendfile() where the OS supports it. An empty
+                # message has nothing to send, and sendfile() refuses a length
+                # of 0, so it is skipped.
+                (offset, length) = extents[msgno-1]
+                if length > 0:
+                    await asyncio.get_running_loop().sendfile(writer.transport, spool, offset, length)
+                await send(writer, END_OF_MSG)
 
             # NOOP command in TRANSACTION state does nothing
-            elif keyword == "NOOP":
+            elif keyword == b"NOOP":
                 log("Nothing to do...")
-                c.sendall(b"+OK\r\n")
+                await send(writer, NOOP_OK)
 
             # DELE command in TRANSACTION state marks one message as "to be deleted"
-            elif keyword == "DELE":
+            elif keyword == b"DELE":
                 msgno = int(args[0])
-                deletions.append(msgno)
+                deletions.add(msgno)
+                live_count = live_count - 1
+                live_bytes = live_bytes - sizes[msgno-1]
                 log("Marked message %d for deletion" % (msgno))
-                c.sendall(("+OK message %d marked for deletion\r\n" % (msgno)).encode())
+                await send(writer, DELE_OK % (msgno))
 
             # RSET command in TRANSACTION state unmarks the "to be deleted" messages
-            elif keyword == "RSET":
+            elif keyword == b"RSET":
                 n = len(deletions)
-                deletions = []
+                deletions.clear()
+                live_count = len(sizes)
+                live_bytes = sum(sizes)
                 log("Unmarked %d messages, they will no longer be deleted" % (n))
-                c.sendall(("+OK unmarked %d messages previosly marked for deletion\r\n" % (n)).encode())
+                await send(writer, RSET_OK % (n))
 
             # QUIT command in TRANSACTION state saves the mailbox,
             # switches to UPDATE or FAILED state, and closes the connection
-            elif keyword == "QUIT" and state == "TRANSACTION":
+            elif keyword == b"QUIT" and state == "TRANSACTION":
                 try:
-                    err = unlock_and_close_mbox(mbox, user, msgs, deletions)
-                except:
+                    err = await asyncio.to_thread(unlock_and_close_mbox, mbox, user, senders, bodies, offsets, deletions)
+                except Exception:
                     log("Oops, failed to close mbox file: %s" % (traceback.format_exc()))
                     err = "Something went wrong saving mbox file"
                 mbox = None
                 if err is not None:
                     log("Sending goodbye error message")
                     state = "FAILED"
-                    c.sendall(("-ERR" + err + "\r\n").encode())
+                    await send(writer, ("-ERR" + err + "\r\n").encode())
                 else:
                     log("Sending goodbye success response")
                     state = "UPDATE"
-                    c.sendall(("+OK goodbye, deleted %d messages, your mailbox is saved\r\n" % (len(deletions))).encode())
+                    await send(writer, GOODBYE_SAVED % (len(deletions)))
                 break # stop the loop
 
             # QUIT command in other states just drops the connection
-            elif keyword == "QUIT":
+            elif keyword == b"QUIT":
                 log("Sending goodbye response")
-                c.sendall(b"+OK goodbye, no mailboxes were changed\r\n")
+                await send(writer, GOODBYE_NO_CHANGE)
                 break # stop the loop
 
             # We should not get here, every message should be handled above.
             else:
                 log("I'm confused, this should not happen")
-                c.sendall(("-ERR Sorry, I'm confused\r\n").encode())
-    except:
+                await send(writer, CONFUSED)
+    except Exception:
         log("Oops, was in %s state but something went wrong: %s" % (state, traceback.format_exc()))
     finally:
-        c.close()
-    log("Final state was " + state)
-    log("Done with connection from " + str(client_addr))
+        writer.close()
+        if spool is not None:
+            spool.close()
+        log("Final state was " + state)
+        log("Done with connection from " + str(client_addr))
 
 
 # open_and_lock_mbox() opens and "locks" a mailbox file. Once locked, the file
@@ -390,24 +527,25 @@ def open_and_lock_mbox(name):
         return (None, "Sorry, mailbox for user %s is busy and locked, try another" % (name))
     return (mbox, None)
 
-# unlock_and_close_mbox() "unlocks" and closes a mailbox file. If msgs and
-# deletions are not None, it also saves the messages before closing the file.
-def unlock_and_close_mbox(mbox, name, msgs, deletions):
+# unlock_and_close_mbox() "unlocks" and closes a mailbox file. If senders,
+# bodies, offsets and deletions are not None, it also saves the messages before
+# closing the file.
+def unlock_and_close_mbox(mbox, name, senders, bodies, offsets, deletions):
     filename = mail_dir + "/" + name
     err = None
-    if msgs is not None and deletions is not None and len(deletions) > 0:
+    if bodies is not None and deletions is not None and len(deletions) > 0:
         log("Saving modified mbox %s" % (filename))
+        first = min(deletions)
         try:
-            mbox.seek(0, 0)
-            mbox.truncate()
-            for (i, msg) in enumerate(msgs):
-                if (i+1) not in deletions:
-                    if i > 0:
-                        mbox.write(b"\n")
-                    mbox.write(("From " + msg[0] + "\n").encode())
-                    for line in msg[2].splitlines(False):
-                        line = re.sub('^>(>*From )', '\1', line)
-                    mbox.write((line + "\n").encode())
+            if len(deletions) == len(bodies) - first + 1:
+                # Only messages at the end of the file were deleted, e.g. the
+                # newest few, so everything before them is unchanged and the
+                # file can just be cut short where the first of them started.
+                mbox.truncate(offsets[first-1])
+                mbox.flush()
+                os.fsync(mbox.fileno())
+            else:
+                save_mbox(mbox, senders, bodies, deletions)
         except:
             log("Failed to properly save mbox: %s" % (traceback.format_exc()))
             err = "Sorry, the mailbox could not be saved, it might be corrupt now"
@@ -427,11 +565,35 @@ def unlock_and_close_mbox(mbox, name, msgs, deletions):
             err = "Sorry, the mailbox could not be properly closed"
     return err
 
-# parse_mbox() parses the user's mailbox file and returns a python list of
-# [source, subject, message] triplets. The source is usually something like
-# "someone@example.com". The subject is a string like "SubjecT: hi there" taken
-# from the email, or it may an empty string. The message is a string, usually
-# containing SMTP email headers and the contents of the email message.
+# save_mbox() rewrites a whole mailbox file, leaving out the deleted messages.
+# Each message is turned back into mbox form: plain "\n" line endings, and
+# the "From " lines that parse_mbox() quoted put back the way they were.
+# Messages are separated by a blank line. The whole new file is built first,
+# then written with a single write() and flushed all the way to disk.
+def save_mbox(mbox, senders, bodies, deletions):
+    msgs = []
+    for i in range(len(bodies)):
+        if (i+1) not in deletions:
+            body = bodies[i].encode().replace(b"\r\n", b"\n")
+            body = _FROM_UNQUOTE.sub(rb'\1', body)
+            msgs.append(b"From " + senders[i].encode() + b"\n" + body)
+    mbox.seek(0, 0)
+    mbox.truncate()
+    mbox.write(b"\n".join(msgs))
+    mbox.flush()
+    os.fsync(mbox.fileno())
+
+# parse_mbox() parses the user's mailbox file and returns six parallel lists:
+# the source, subject, size and contents of each message, the line LIST sends
+# for it, and the offset in the file where it starts. The source is usually
+# something like "someone@example.com". The subject is a string like "SubjecT:
+# hi there" taken from the email, or it may an empty string. The size is the
+# length of the message. Sizes are kept in a compact array.array of plain
+# machine integers, so adding them up still reads every size, but doesn't have
+# to touch a separate python object for each message. The message is a string,
+# usually containing SMTP email headers and the contents of the email message.
+# The LIST lines are formatted and encoded here once, rather than every time
+# a client asks for a listing.
 #
 # Each mbox file contains one user's mail. The mbox format is just a 
 # concatenation of all the user's email messages, with each message
@@ -440,64 +602,117 @@ def unlock_and_close_mbox(mbox, name, msgs, deletions):
 # the contents of the message.
 def parse_mbox(mbox):
     try:
-        msgs = []
-        # Split the entire file into lines, and process each
-        # line one at a time. Don't keep the line endings.
-        mbox.seek(0, 0)
-        lines = mbox.read().splitlines(False)
-        prevblank = True
-        for line in lines:
-            line = line.decode() # convert from bytes to python string
-            # Look for the start of a new message
-            if prevblank and line.startswith("From "):
-                msgfrom = line[5:].strip()
+        senders = []
+        subjects = []
+        sizes = array.array('q')
+        bodies = []
+        list_lines = []
+        offsets = array.array('q')
+        # Map the whole file into memory, rather than reading it in, so only
+        # one message at a time gets copied out of the operating system's
+        # page cache. An empty file can't be mapped, but has no messages.
+        if os.fstat(mbox.fileno()).st_size == 0:
+            return (senders, subjects, sizes, bodies, list_lines, offsets)
+        with mmap.mmap(mbox.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Ignore the newline that ends the last line of the file, so that
+            # a blank line at the very end is kept as part of the last
+            # message, just like a blank line in the middle of a message.
+            size = len(data)
+            if data[size-1] == ord("\n"):
+                size = size - 1
+                if size > 0 and data[size-1] == ord("\r"):
+                    size = size - 1
+            elif data[size-1] == ord("\r"):
+                size = size - 1
+            # Find where each message starts with one regex scan, rather than
+            # looking at the file line by line. Anything before the first
+            # "From " line is ignored.
+            starts = list(_FROM_SPLIT.finditer(data, 0, size))
+            for (k, start) in enumerate(starts):
+                if k+1 < len(starts):
+                    end = starts[k+1].start()
+                else:
+                    end = size
+                # The rest of the "From " line is the source, what follows is
+                # the message itself.
+                part = data[start.end():end]
+                newline = _LINE_END.search(part)
                 msgsubj = ""
                 msgbody = ""
-                msgs.append([msgfrom, msgsubj, msgbody])
-                prevblank = False
-            # Ignore anything before the first "From " line
-            elif len(msgs) == 0:
-                prevblank = re.match('^$', line)
-            else:
-                # A previously-seen blank line was followed by something
-                # other than "From ", so it should have been part of the
-                # message. Add it now.
-                if prevblank:
-                    msgs[-1][2] += "\r\n"
-                    prevblank = False
-                # Check whether we found a blank line or part of message.
-                if re.match('^$', line):
-                    prevblank = True
+                if newline:
+                    msgfrom = part[:newline.start()].strip()
+                    body = part[newline.end():]
+                    # Most files only use "\n", which a plain replace() can
+                    # turn into "\r\n", but any other line endings need the
+                    # regex.
+                    if b"\r" in body:
+                        body = _LINE_END.sub(b"\r\n", body)
+                    else:
+                        body = body.replace(b"\n", b"\r\n")
+                    body = _FROM_QUOTE.sub(rb'>\1', body)
+                    msgbody = body.decode() + "\r\n"
                 else:
-                    line = re.sub('^(>*From )', '>\1', line)
-                    msgs[-1][2] += line + "\r\n"
-                    #if line.startswith("Subject: ") and msgs[-1][1] == "":
-                    #    msgs[-1][1] = line.strip()
-        # A previously-seen blank line was followed by end of file,
-        # so it should have been part of the last message. Add it now.
-        if prevblank and len(msgs) > 0:
-            msgs[-1][2] += "\r\n"
-            prevblank = False
-        # All lines of mbox file have been examined.
-        # Print out a summary (just for debug purposes) and
-        # return the list of (source, message) pairs.
-        return msgs
+                    msgfrom = part.strip()
+                senders.append(msgfrom.decode()) # convert from bytes to python string
+                subjects.append(msgsubj)
+                sizes.append(len(msgbody))
+                bodies.append(msgbody)
+                list_lines.append(b"%d %d %s %s\r\n" % (k+1, len(msgbody), msgfrom, msgsubj.encode()))
+                # Each message after the first starts just past the line
+                # ending of the previous message, at the blank line before it.
+                if k == 0:
+                    offsets.append(0)
+                else:
+                    offsets.append(start.end(1))
+        # All messages of mbox file have been examined.
+        return (senders, subjects, sizes, bodies, list_lines, offsets)
     except:
         log("Problem reading mailbox file: " + traceback.format_exc())
         return None
 
+# spool_messages() writes all the message bodies to a temporary file, exactly as
+# RETR will send them: with "\r\n" line endings, and with lines "byte-stuffed"
+# as needed. It returns a pair containing the file and a list of (offset,
+# length) pairs saying where each message is in that file, or (None, None) if
+# something went wrong. This way RETR can hand a message from the file directly
+# to the socket with sendfile(), without copying it through python at all.
+def spool_messages(bodies):
+    try:
+        spool = tempfile.TemporaryFile()
+    except:
+        log("Problem creating spool file: " + traceback.format_exc())
+        return (None, None)
+    try:
+        extents = []
+        offset = 0
+        for body in bodies:
+            # if a line starts with "." we must "byte-stuff" an extra "." at
+            # the start, because a lone "." is used to mark the end of the
+            # message. One regex substitution does this for every line.
+            data = _DOT_STUFF.sub(b"..", body.encode())
+            spool.write(data)
+            extents.append((offset, len(data)))
+            offset += len(data)
+        spool.flush()
+        return (spool, extents)
+    except:
+        log("Problem writing spool file: " + traceback.format_exc())
+        spool.close()
+        return (None, None)
+
 # print_mailbox_stats() just prints some statistics, useful for debugging.
 def print_mailbox_stats(user):
     mbox, err = open_and_lock_mbox(user)
     if err is not None:
         log(err)
         return None
-    msgs = parse_mbox(mbox)
-    if msgs is not None:
-        nn = len(msgs)
-        mm = sum([len(msg[2]) for msg in msgs])
-        log("%s has %d messages with a total of %d bytes" % (name, nn, mm))
-    unlock_and_close_mbox(mbox, user, None, None)
+    parsed = parse_mbox(mbox)
+    if parsed is not None:
+        (senders, subjects, sizes, bodies, list_lines, offsets) = parsed
+        nn = len(sizes)
+        mm = sum(sizes)
+        log("%s has %d messages with a total of %d bytes" % (user, nn, mm))
+    unlock_and_close_mbox(mbox, user, None, None, None, None)
 
 
 #######################################################################
@@ -515,6 +730,12 @@ if len(sys.argv) >= 3:
     mail_dir = sys.argv[2]
 
 
+# Start the logging thread. It is a daemon thread, so it can't keep the program
+# running, but stop_logging() still lets it finish printing before we exit.
+log_thread = threading.Thread(target=print_log_messages, name="log", daemon=True)
+log_thread.start()
+atexit.register(stop_logging)
+
 # Print a welcome message.
 server_addr = (server_host, server_port)
 log("Starting POP3 server")
@@ -523,9 +744,12 @@ log("Serving mailbox files from %s" % (mail_dir))
 
 # Do a quick scan of the mail directory, just to see which mbox files are
 # present and how big they are. This is just a sanity check, for debugging.
-for name in os.listdir(mail_dir):
-    if os.path.isfile(mail_dir + "/" + name) and not name[:-1].endswith(".sw"):
-        print_mailbox_stats(name)
+# os.scandir() already knows which entries are files from reading the
+# directory, so this doesn't need an extra stat() call for each one.
+with os.scandir(mail_dir) as entries:
+    for entry in entries:
+        if entry.is_file() and not entry.name[:-1].endswith(".sw"):
+            print_mailbox_stats(entry.name)
 
 
 # Create the server socket, and set it up to listen for connections
@@ -534,15 +758,31 @@ s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 s.bind(server_addr)
 s.listen(5)
 
-# Finally, we repeatedly accept and process connections from clients
-log("==== Ready for connections ====")
-done = False
+# Finally, we hand the server socket to asyncio, which accepts connections from
+# clients and runs handle_pop3_connection() for each one, until some connection
+# asks us to exit by setting shutdown_requested. Only coroutines on the event
+# loop's thread ever touch that event, never the worker threads, so there is no
+# data shared between threads that would need a lock (even without the GIL).
+# Blocking mailbox work is sent to mbox_threads worker threads with
+# asyncio.to_thread().
+#
+# When asked to exit, we just stop accepting new connections. We don't wait for
+# the other clients to finish (newer pythons would wait for them forever in
+# server.wait_closed()); instead asyncio.run() cancels their connections.
+shutdown_requested = asyncio.Event()
+
+async def serve_until_done():
+    workers = concurrent.futures.ThreadPoolExecutor(max_workers=mbox_threads, thread_name_prefix="mbox")
+    asyncio.get_running_loop().set_default_executor(workers)
+    server = await asyncio.start_server(handle_pop3_connection, sock=s, backlog=5)
+    try:
+        log("==== Ready for connections ====")
+        await shutdown_requested.wait()
+    finally:
+        server.close()
+
 try:
-    while not done:
-        c, client_addr = s.accept()
-        t = threading.Thread(target=handle_pop3_connection, args=(c,client_addr))
-        t.daemon = True
-        t.start()
+    asyncio.run(serve_until_done())
 finally:
     log("==== Server is shutting down ====")
     s.close()